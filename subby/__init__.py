@@ -1,10 +1,15 @@
 from typing import Optional, Sequence, Type, Union
 
-from subby.core import CalledProcessError, Mode, StdType, Processes
+from subby.core import (
+    DEFAULT_EXECUTABLE,
+    CalledProcessError,
+    Mode,
+    StdType,
+    Processes,
+)
+from subby.pool import ShellPool
 from subby import utils
 
-DEFAULT_EXECUTABLE = "/bin/bash"
-
 
 def cmd(
     cmd: Sequence[str],
@@ -1,19 +1,37 @@
-import copy
 import enum
 import errno
 import logging
+import math
 import os
 from pathlib import Path
+import select
 import subprocess
 from subprocess import CalledProcessError
 import sys
-import tempfile
-from typing import Generic, IO, Optional, Sequence, Tuple, Type, TypeVar, Union, cast
+import threading
+import time
+from typing import (
+    Generic,
+    IO,
+    Iterator,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    cast,
+)
 
 from subby.utils import command_lists_to_strings
 
+# Note: shutil and tempfile are imported only where they are needed, to keep
+# `import subby` fast
+
 LOG = logging.getLogger()
 DEFAULT_EXECUTABLE = "/bin/bash"
+READ_CHUNK_SIZE = 65536
+PIPE_BUF = getattr(select, "PIPE_BUF", 512)
 
 
 class StdType(enum.IntEnum):
@@ -31,6 +49,111 @@ class StdType(enum.IntEnum):
 Mode = TypeVar("Mode", str, bytes)
 
 
+def _pidfd_open(pid: int) -> Optional[int]:
+    """
+    Opens a file descriptor that becomes readable when process `pid` exits.
+
+    Returns:
+        The file descriptor, or None if pidfds are not supported by the platform
+        or kernel.
+    """
+    if hasattr(os, "pidfd_open"):
+        try:
+            return os.pidfd_open(pid)
+        except OSError:
+            pass
+    return None
+
+
+def _which(program: str, env: Optional[dict] = None) -> Optional[str]:
+    """
+    Resolves the absolute path of `program` using the same search path that
+    `subprocess` would use.
+
+    Returns:
+        The absolute path, or None if `program` is not a bare program name or
+        could not be found.
+    """
+    if os.path.dirname(program):
+        return None
+    import shutil
+
+    return shutil.which(program, path=os.pathsep.join(os.get_exec_path(env)))
+
+
+class _Drain:
+    """
+    Reads a file descriptor until EOF on a background thread, accumulating the
+    data in memory.
+    """
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.buf = bytearray()
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        while True:
+            chunk = os.read(self.fd, READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            self.buf.extend(chunk)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for EOF to be reached.
+
+        Args:
+            timeout: Maximum number of seconds to wait, or None to wait forever.
+
+        Returns:
+            True if EOF was reached, otherwise False.
+        """
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+
+class _PipeBuffer:
+    """
+    Captures an output stream in memory. The write end of an OS pipe is passed to
+    the subprocess, and the read end is drained into a buffer.
+    """
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        self._drain = None
+
+    def fileno(self) -> int:
+        return self._write_fd
+
+    def start(self):
+        """
+        Closes the parent's copy of the write end and starts draining the read end.
+        Must be called after the subprocess that writes to the pipe has started.
+        """
+        os.close(self._write_fd)
+        self._write_fd = None
+        self._drain = _Drain(self._read_fd)
+
+    def close(self) -> bytes:
+        """
+        Waits for the writer to close the pipe, then closes the read end.
+
+        Returns:
+            The captured bytes.
+        """
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+        data = b""
+        if self._drain is not None:
+            self._drain.join()
+            data = bytes(self._drain.buf)
+        os.close(self._read_fd)
+        return data
+
+
 class Processes(Generic[Mode]):
     """
     Encapsulates one or more commands, runs those commands using the
@@ -65,9 +188,18 @@ class Processes(Generic[Mode]):
         timeout: When blocking, number of seconds to wait for the process to complete
             before raising a TimeoutError (can be overridden by `timeout` parameter
             to `block()`).
-        popen_kwargs: Keyword arguments to pass to Popen constructors.
+        popen_kwargs: Keyword arguments to pass to Popen constructors. Note that
+            passing `preexec_fn`, `cwd`, `pass_fds` or `close_fds` prevents
+            `subprocess` from using the faster `posix_spawn` to start the processes.
     """
 
+    # Whether to pass `close_fds=False` to Popen (unless `close_fds` or `pass_fds`
+    # is specified in `popen_kwargs`), which is required for `subprocess` to use
+    # `posix_spawn`. This is safe because all of the fds that subby opens are
+    # non-inheritable; set to False if the parent process has inheritable fds
+    # that must not leak into the child processes.
+    fast_spawn = True
+
     def __init__(
         self,
         cmds: Sequence[Union[str, Sequence[str]]],
@@ -99,6 +231,7 @@ class Processes(Generic[Mode]):
                 )
 
         self.cmds = cmds
+        self._cmd_str = None
         self._stdin_arg = stdin
         self._stdin = None
         self._stdin_type = None
@@ -120,6 +253,8 @@ class Processes(Generic[Mode]):
         self.raise_on_error = raise_on_error
         self.timeout = timeout
         self._processes = None
+        self._pidfds = None
+        self._pipe_drains = None
         self._output_handle = None
         self._returncode = None
         self._out = None
@@ -145,7 +280,7 @@ class Processes(Generic[Mode]):
             ):
                 # The last process finished running without error, but check all
                 # the other processes for an error.
-                for proc in reversed(self._processes[-2::-1]):
+                for proc in self._processes[:-1]:
                     rc = proc.poll()
                     if rc:
                         self._returncode = rc
@@ -186,30 +321,29 @@ class Processes(Generic[Mode]):
         std_type = StdType.OTHER
         stream = None
         retval = None
-        if isinstance(value, bytes):
+        if isinstance(value, (bytes, str)):
             std_type = StdType.BUFFER
-            # Put input in a tempfile
-            stream = self._create_and_open_tempfile("w+")
-            if self.text_mode:
-                stream.write(cast(bytes, value).decode(self.encoding))
+            if isinstance(value, str):
+                value = value.encode(self.encoding)
+            if len(value) <= PIPE_BUF:
+                # Small inputs can be written to a pipe up front without blocking
+                read_fd, write_fd = os.pipe()
+                try:
+                    os.write(write_fd, value)
+                finally:
+                    os.close(write_fd)
+                retval = read_fd
             else:
-                stream.write(cast(bytes, value))
-            stream.seek(0)
-        elif isinstance(value, str):
-            std_type = StdType.BUFFER
-            # Put input in a tempfile
-            stream = self._create_and_open_tempfile("w+")
-            if self.text_mode:
-                stream.write(cast(str, value))
-            else:
-                stream.write(cast(str, value).encode(self.encoding))
-            stream.seek(0)
+                # Put larger input in a tempfile
+                stream = self._create_and_open_tempfile()
+                stream.write(value)
+                stream.seek(0)
         elif isinstance(value, StdType):
             std_type = cast(StdType, value)
             if std_type is StdType.PIPE:
                 retval = subprocess.PIPE
             elif std_type is StdType.BUFFER and is_output:
-                stream = self._create_and_open_tempfile()
+                stream = _PipeBuffer()
             elif std_type is StdType.SYS:
                 stream = sys_stream
             else:
@@ -220,28 +354,45 @@ class Processes(Generic[Mode]):
 
         return stream, std_type, retval or stream
 
-    def _get_stderr_buffer(self) -> IO:
+    def _get_stderr_buffer(self) -> Optional[_PipeBuffer]:
         """
-        Creates a temporary file to use for storing a stderr stream.
+        Creates an in-memory buffer to use for capturing a stderr stream.
 
         Returns:
-            The opened file object.
+            The buffer, or None if `self.capture_stderr` is False.
         """
         if self.capture_stderr:
-            handle = self._create_and_open_tempfile()
-            self._stderr_buffers.append(handle)
-            return handle
+            buf = _PipeBuffer()
+            self._stderr_buffers.append(buf)
+            return buf
 
     def _open_file(self, path: Union[str, Path], mode: str) -> IO:
         mode += "t" if self.text_mode else "b"
         return open(path, mode)
 
-    def _create_and_open_tempfile(self, mode: str = "w") -> IO:
+    def _create_and_open_tempfile(self) -> IO:
         """
-        Creates and returns a temporary output file object.
+        Creates and returns an anonymous temporary file object opened for reading
+        and writing bytes. The file is memory-backed where `os.memfd_create` is
+        available, and in any case has no name, so it does not need to be removed.
         """
-        mode += "t" if self.text_mode else "b"
-        return open(tempfile.mkstemp()[1], mode)
+        if hasattr(os, "memfd_create"):
+            try:
+                return os.fdopen(os.memfd_create("subby", os.MFD_CLOEXEC), "w+b")
+            except OSError:
+                pass
+        import tempfile
+
+        return tempfile.TemporaryFile("w+b")
+
+    def _decode(self, data: bytes) -> Mode:
+        """
+        Decodes captured bytes if `self.text_mode` is True, translating newlines
+        the same way as `subprocess` does for text-mode streams.
+        """
+        if self.text_mode:
+            return data.decode(self.encoding).replace("\r\n", "\n").replace("\r", "\n")
+        return data
 
     @property
     def output(self) -> Mode:
@@ -332,17 +483,22 @@ class Processes(Generic[Mode]):
             A list of strings, where each string is the captured stderr stream of a
             process.
         """
+        return list(self._iter_stderr())
+
+    def _iter_stderr(self) -> Iterator[Mode]:
+        """
+        Iterates over the contents of all available stderr streams (see
+        `get_all_stderr`).
+        """
         if not self.closed:
             raise RuntimeError(
                 "Cannot access 'stderr' contents until all processes have completed "
                 "and file handles have been closed."
             )
-        stderr = []
         if self.capture_stderr:
-            stderr.extend(self._stderr_content)
+            yield from self._stderr_content
         if self._stderr_type in (StdType.BUFFER, StdType.PIPE):
-            stderr.append(self.error)
-        return stderr
+            yield self.error
 
     @property
     def was_run(self) -> bool:
@@ -389,33 +545,117 @@ class Processes(Generic[Mode]):
         if echo is None:
             echo = self.echo
         if echo is not False:
-            LOG.info(str(self))
+            LOG.info("%s", self)
 
         num_commands = len(self.cmds)
         procs = []
-
-        for i, cmd in enumerate(self.cmds, 1):
-            popen_kwargs = copy.copy(self.popen_kwargs)
-            popen_kwargs.update(kwargs)
-            if self.text_mode:
-                popen_kwargs["universal_newlines"] = True
-                popen_kwargs["encoding"] = self.encoding
-            if i == 1:
-                popen_kwargs["stdin"] = self._init_stdin()
-            elif procs:
-                popen_kwargs["stdin"] = procs[-1].stdout
-            if i == num_commands:
-                popen_kwargs["stdout"] = self._init_stdout()
-                popen_kwargs["stderr"] = self._init_stderr()
-            else:
-                popen_kwargs["stdout"] = subprocess.PIPE
-                popen_kwargs["stderr"] = self._get_stderr_buffer()
-            proc = subprocess.Popen(cmd, **popen_kwargs)
-            if procs:
-                procs[-1].stdout.close()
-            procs.append(proc)
+        pidfds = {}
+
+        # The same kwargs are used for every process; only the executable and
+        # stdin/stdout/stderr differ between processes.
+        base_kwargs = {**self.popen_kwargs, **kwargs}
+        if self.text_mode:
+            base_kwargs["universal_newlines"] = True
+            base_kwargs["encoding"] = self.encoding
+        # `subprocess` can only start a process using `posix_spawn` (which is
+        # much faster than `fork` for large parent processes) if the executable is
+        # an absolute path and fds are not closed, so resolve the executable and
+        # disable `close_fds` up front where that is possible.
+        can_spawn = not (base_kwargs.get("preexec_fn") or base_kwargs.get("cwd"))
+        resolve_executable = can_spawn and not (
+            base_kwargs.get("shell") or base_kwargs.get("executable")
+        )
+        if (
+            can_spawn
+            and self.fast_spawn
+            and "close_fds" not in base_kwargs
+            and not base_kwargs.get("pass_fds")
+        ):
+            base_kwargs["close_fds"] = False
+
+        # Pipe fds that belong to the parent and must be closed once the process
+        # that uses them has started (or if starting a process fails)
+        parent_fds = set()
+        next_stdin = None
+
+        try:
+            for i, cmd in enumerate(self.cmds, 1):
+                if i == 1:
+                    stdin = self._init_stdin()
+                    if self._stdin_type is StdType.BUFFER and self._stdin is None:
+                        parent_fds.add(stdin)
+                else:
+                    stdin = next_stdin
+                if i == num_commands:
+                    stdout = self._init_stdout()
+                    stderr = self._init_stderr()
+                else:
+                    # Connect the processes with a pipe of our own rather than
+                    # `subprocess.PIPE`, so no file object is created for an fd that
+                    # we never read.
+                    next_stdin, stdout = os.pipe()
+                    parent_fds.update((next_stdin, stdout))
+                    stderr = self._get_stderr_buffer()
+                if resolve_executable and not isinstance(cmd, str) and cmd:
+                    executable = _which(str(cmd[0]), base_kwargs.get("env"))
+                else:
+                    executable = base_kwargs.get("executable")
+                proc = subprocess.Popen(
+                    cmd,
+                    **{
+                        **base_kwargs,
+                        "executable": executable,
+                        "stdin": stdin,
+                        "stdout": stdout,
+                        "stderr": stderr,
+                    },
+                )
+                procs.append(proc)
+                # Close our copies of the pipe ends that now belong to the process
+                for fd in (stdin, stdout):
+                    if fd in parent_fds:
+                        parent_fds.remove(fd)
+                        os.close(fd)
+                for std in (stdout, stderr):
+                    if isinstance(std, _PipeBuffer):
+                        std.start()
+                if pidfds is not None:
+                    pidfd = _pidfd_open(proc.pid)
+                    if pidfd is None:
+                        pidfds = None
+                    else:
+                        pidfds[pidfd] = proc
+        except BaseException:
+            self._abort_run(procs, pidfds, parent_fds)
+            raise
 
         self._processes = procs
+        self._pidfds = pidfds
+
+    def _abort_run(self, procs, pidfds, parent_fds):
+        """
+        Cleans up after a failure to start one of the processes: kills the
+        processes that were already started and closes every fd and file that was
+        opened for them, so that a failed `run()` does not leak anything.
+        """
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        for fd in (*(pidfds or ()), *parent_fds):
+            os.close(fd)
+        if self.capture_stderr:
+            for buf in self._stderr_buffers:
+                buf.close()
+            self._stderr_buffers.clear()
+        if self._stdin_type in {StdType.FILE, StdType.BUFFER}:
+            if self._stdin is not None:
+                self._stdin.close()
+        for stream, std_type in (
+            (self._stdout, self._stdout_type),
+            (self._stderr, self._stderr_type),
+        ):
+            if std_type in {StdType.FILE, StdType.BUFFER}:
+                stream.close()
 
     def block(
         self,
@@ -438,22 +678,34 @@ class Processes(Generic[Mode]):
         if self.closed:
             raise RuntimeError("Cannot call block() after calling close()")
 
-        default_value = "" if self.text_mode else b""
         last_proc = self._processes[-1]
         if timeout is None:
             timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
 
-        try:  # TODO: figure out how to test this
-            out, err = (
-                default_value if std is None else std.strip()
-                for std in last_proc.communicate(timeout=timeout)
-            )
-            if self._stdout_type == StdType.PIPE:
-                self._out = out
-            if self._stderr_type == StdType.PIPE:
-                self._err = err
-        except ValueError:  # TODO: figure out how to test this
-            LOG.exception("Error reading from stdout/stderr")
+        def remaining() -> Optional[float]:
+            if deadline is None:
+                return None
+            return max(deadline - time.monotonic(), 0)
+
+        if self._pipe_drains is None:
+            self._start_pipe_drains()
+
+        if self._pidfds is not None:
+            self._wait_pidfds(remaining())
+        else:
+            try:
+                last_proc.wait(remaining())
+            except subprocess.TimeoutExpired:
+                raise subprocess.TimeoutExpired(last_proc.args, timeout)
+
+        for drain, _ in self._pipe_drains.values():
+            if not drain.join(remaining()):
+                raise subprocess.TimeoutExpired(last_proc.args, timeout)
+        if "stdout" in self._pipe_drains:
+            self._out = self._finish_pipe_drain("stdout")
+        if "stderr" in self._pipe_drains:
+            self._err = self._finish_pipe_drain("stderr")
 
         if close and not self.closed:
             self._close_and_set_std()
@@ -463,6 +715,66 @@ class Processes(Generic[Mode]):
         if raise_on_error is not False:
             self.raise_if_error()
 
+    def _start_pipe_drains(self):
+        """
+        Closes the stdin pipe (if any) of the first process, and starts draining
+        the stdout and stderr pipes (if any) of the last process, so that the
+        processes can't block on a full pipe while we wait for them to finish.
+        Pipes that the caller has already closed are skipped.
+        """
+        self._pipe_drains = {}
+        stdin = self._processes[0].stdin
+        if stdin is not None and not stdin.closed:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                # The process exited without reading all of its input
+                pass
+        last_proc = self._processes[-1]
+        for name in ("stdout", "stderr"):
+            stream = getattr(last_proc, name)
+            if stream is not None and not stream.closed:
+                self._pipe_drains[name] = (_Drain(stream.fileno()), stream)
+
+    def _finish_pipe_drain(self, name: str) -> Mode:
+        """
+        Closes a drained pipe.
+
+        Returns:
+            The stripped contents of the pipe.
+        """
+        drain, stream = self._pipe_drains.pop(name)
+        stream.close()
+        return self._decode(bytes(drain.buf)).strip()
+
+    def _wait_pidfds(self, timeout: Optional[float] = None):
+        """
+        Waits for the last process to exit by polling the pidfds of all processes
+        at once, reaping each process as soon as it exits.
+
+        Args:
+            timeout: Seconds to wait before raising `subprocess.TimeoutExpired`; if
+                None, waits until the last process has exited.
+        """
+        last_proc = self._processes[-1]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        poller = select.poll()
+        for pidfd in self._pidfds:
+            poller.register(pidfd, select.POLLIN)
+
+        while last_proc.returncode is None:
+            if deadline is None:
+                poll_timeout = None
+            else:
+                poll_timeout = max(math.ceil((deadline - time.monotonic()) * 1000), 0)
+            ready = poller.poll(poll_timeout)
+            if not ready:
+                raise subprocess.TimeoutExpired(last_proc.args, timeout)
+            for pidfd, _ in ready:
+                poller.unregister(pidfd)
+                self._pidfds.pop(pidfd).wait()
+                os.close(pidfd)
+
     def kill(self) -> bool:
         """
         Kill the running commands. It is recommended to call `close()` if this
@@ -523,40 +835,30 @@ class Processes(Generic[Mode]):
             except IOError:
                 LOG.exception("Error closing output file %s", handle.name)
 
-        def remove_file(handle):
-            try:
-                os.unlink(handle.name)
-            except IOError:  # TODO: figure out how to test
-                LOG.exception("Error removing file %s", handle.name)
+        if self._pidfds:
+            for pidfd in self._pidfds:
+                os.close(pidfd)
+            self._pidfds.clear()
 
-        if self._stdin_type in {StdType.FILE, StdType.BUFFER}:
-            try:
-                close_file(self._stdin)
-            finally:
-                if self._stdin_type is StdType.BUFFER:
-                    remove_file(self._stdin)
-
-        def close_output_buffer(handle) -> Mode:
-            close_file(handle)
-            try:
-                with self._open_file(handle.name, "r") as inp:
-                    return inp.read()
-            finally:
-                remove_file(handle)
+        if self._stdin is not None and self._stdin_type in {
+            StdType.FILE,
+            StdType.BUFFER,
+        }:
+            close_file(self._stdin)
 
         if self._stdout_type is StdType.FILE:
             close_file(self._stdout)
         elif self._stdout_type is StdType.BUFFER:
-            self._out = close_output_buffer(self._stdout)
+            self._out = self._decode(self._stdout.close())
 
         if self._stderr_type is StdType.FILE:
             close_file(self._stderr)
         elif self._stderr_type is StdType.BUFFER:
-            self._err = close_output_buffer(self._stderr)
+            self._err = self._decode(self._stderr.close())
 
         if self.capture_stderr:
             self._stderr_content = [
-                close_output_buffer(buf) for buf in self._stderr_buffers
+                self._decode(buf.close()) for buf in self._stderr_buffers
             ]
             self._stderr_buffers = None
 
@@ -573,12 +875,14 @@ class Processes(Generic[Mode]):
         if self.done and not self.ok:
             sep = "\n" if self.text_mode else b"\n"
             msg = "stderr from executed commands:\n{}".format(
-                sep.join(self.get_all_stderr())
+                sep.join(self._iter_stderr())
             )
             raise CalledProcessError(self.returncode, str(self), output=msg)
 
     def __str__(self) -> str:
-        cmd_str = " | ".join(command_lists_to_strings(self.cmds))
+        if self._cmd_str is None:
+            self._cmd_str = " | ".join(command_lists_to_strings(self.cmds))
+        cmd_str = self._cmd_str
         if self._stdout_type == StdType.FILE:
             cmd_str += " > {}".format(self._stdout.name)
         return cmd_str
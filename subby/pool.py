@@ -0,0 +1,197 @@
+import os
+import re
+import selectors
+import subprocess
+import threading
+from typing import Optional, Sequence, Type, Union
+
+from subby.core import DEFAULT_EXECUTABLE, READ_CHUNK_SIZE, Mode
+from subby.utils import command_lists_to_strings, quote_args
+
+
+class ShellPool:
+    """
+    A persistent shell process that runs commands sent to it over a pipe. Running
+    a command with a `ShellPool` avoids the cost of starting a new shell (and
+    forking the Python process) for each command, which dominates the run time of
+    short commands.
+
+    Commands are run one at a time, in the same shell process, with stdin
+    redirected from `/dev/null`. Because the shell is shared, any changes a
+    command makes to the shell state (e.g. `cd` or setting variables) persist
+    for subsequent commands, and a command that exits the shell closes the pool.
+
+    Args:
+        executable: The shell executable.
+        mode: Mode to use for stdout/stderr; can be bytes (raw mode) or str
+            (text mode).
+        encoding: Encoding to use when `mode = str`.
+        allowed_return_codes: Sequence of return codes that signal successful
+            completion; [0] by default.
+        popen_kwargs: Keyword arguments to pass to the Popen constructor of the
+            shell process.
+
+    Examples:
+        with subby.ShellPool() as pool:
+            assert pool.run("echo foo | wc -l").stdout == "1"
+    """
+
+    def __init__(
+        self,
+        executable: str = DEFAULT_EXECUTABLE,
+        mode: Type[Mode] = str,
+        encoding: str = "UTF-8",
+        allowed_return_codes: Sequence[int] = (0,),
+        **popen_kwargs,
+    ):
+        self.executable = executable
+        self._mode = mode
+        self.encoding = encoding
+        self.allowed_return_codes = set(allowed_return_codes)
+        self.popen_kwargs = popen_kwargs
+        self._shell = None
+        self._lock = threading.Lock()
+        # A token that is unlikely to occur in the output of any command marks the
+        # end of each command's output on stdout (followed by the return code) and
+        # stderr
+        token = os.urandom(8).hex().encode()
+        self._stdout_end = re.compile(rb"\0" + token + rb" (\d+)\n\Z")
+        self._stderr_end = b"\0" + token + b"\n"
+        self._epilog = (
+            b" </dev/null; printf '\\0%s %d\\n' "
+            + token
+            + b" $?; printf '\\0%s\\n' "
+            + token
+            + b" >&2\n"
+        )
+
+    @property
+    def closed(self) -> bool:
+        return self._shell is None
+
+    def start(self):
+        """
+        Starts the shell process. Called automatically by `run()` if the shell has
+        not been started.
+        """
+        if self._shell is not None:
+            raise RuntimeError("The shell has already been started.")
+        self._shell = subprocess.Popen(
+            [self.executable, "-s"],
+            **{
+                **self.popen_kwargs,
+                "stdin": subprocess.PIPE,
+                "stdout": subprocess.PIPE,
+                "stderr": subprocess.PIPE,
+            },
+        )
+
+    def run(
+        self, cmds: Union[str, Sequence[Union[str, Sequence[str]]]]
+    ) -> subprocess.CompletedProcess:
+        """
+        Runs a command (or several commands piped together) in the shell.
+
+        Args:
+            cmds: The command(s) to run; a string or a sequence of command strings
+                or sequences of command arguments to pipe together.
+
+        Returns:
+            A :class:`subprocess.CompletedProcess` with the return code of the
+            (last) command and the contents of its stdout and stderr.
+
+        Raises:
+            subprocess.CalledProcessError: if the return code is not in
+                `self.allowed_return_codes`.
+        """
+        if isinstance(cmds, str):
+            cmd_str = cmds
+        else:
+            cmd_str = " | ".join(command_lists_to_strings(cmds))
+
+        with self._lock:
+            if self._shell is None:
+                self.start()
+            # The command is passed to `eval` so that a syntax error in the command
+            # does not break the shell's parsing of the following input
+            script = b"eval " + quote_args([cmd_str]).encode(self.encoding)
+            try:
+                self._shell.stdin.write(script + self._epilog)
+                self._shell.stdin.flush()
+            except BrokenPipeError:
+                self.close()
+                raise RuntimeError("The shell exited unexpectedly.")
+            stdout, stderr = self._read_output()
+
+        returncode = int(self._stdout_end.search(stdout).group(1))
+        stdout = self._decode(stdout[: stdout.rindex(b"\0")])
+        stderr = self._decode(stderr[: -len(self._stderr_end)])
+        if returncode not in self.allowed_return_codes:
+            raise subprocess.CalledProcessError(returncode, cmd_str, stdout, stderr)
+        return subprocess.CompletedProcess(cmd_str, returncode, stdout, stderr)
+
+    def _read_output(self):
+        """
+        Reads stdout and stderr of the shell until the end of the current command's
+        output has been reached on both streams.
+        """
+        stdout = bytearray()
+        stderr = bytearray()
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._shell.stdout, selectors.EVENT_READ, stdout)
+            selector.register(self._shell.stderr, selectors.EVENT_READ, stderr)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    data = os.read(key.fd, READ_CHUNK_SIZE)
+                    if not data:
+                        self.close()
+                        raise RuntimeError("The shell exited unexpectedly.")
+                    buf = key.data
+                    buf += data
+                    # The end marker is short, so only the tail of stdout needs
+                    # to be searched
+                    if (
+                        self._stdout_end.search(buf, max(len(buf) - 64, 0))
+                        if buf is stdout
+                        else buf.endswith(self._stderr_end)
+                    ):
+                        selector.unregister(key.fileobj)
+        return bytes(stdout), bytes(stderr)
+
+    def _decode(self, data: bytes) -> Mode:
+        if self._mode is bytes:
+            return data.strip()
+        return (
+            data.decode(self.encoding).replace("\r\n", "\n").replace("\r", "\n").strip()
+        )
+
+    def close(self, timeout: Optional[float] = None):
+        """
+        Closes the shell's stdin and waits for it to exit.
+
+        Args:
+            timeout: Seconds to wait for the shell to exit before killing it.
+        """
+        shell = self._shell
+        if shell is None:
+            return
+        self._shell = None
+        try:
+            shell.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            shell.wait(timeout)
+        except subprocess.TimeoutExpired:
+            shell.kill()
+            shell.wait()
+        shell.stdout.close()
+        shell.stderr.close()
+
+    def __enter__(self) -> "ShellPool":
+        if self._shell is None:
+            self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,5 +1,26 @@
-import shlex
-from typing import Sequence, Union
+import re
+from typing import List, Sequence, Union
+
+# Note: shlex is imported only where it is needed, to keep `import subby` fast
+
+# Matches any character that `shlex.split` treats specially: quotes, the escape
+# character, and whitespace other than the characters it splits on.
+_find_shlex_special = re.compile(r"['\"\\]|[^\S \t\r\n]").search
+# Scans a command string for the tokens recognized by `shlex.split` in POSIX mode:
+# group 1 matches a word, which is any run of unquoted characters, escaped
+# characters and single- or double-quoted strings; whitespace between words is
+# skipped; and group 2 matches the first character of an unterminated quote or a
+# trailing escape character.
+_scan_command = re.compile(
+    r"""((?:[^ \t\r\n'"\\]|\\.|'[^']*'|"(?:[^"\\]|\\.)*")+)|[ \t\r\n]+|(.)""", re.S
+).finditer
+# Matches the escape sequences and quoted strings within a word
+_unquote_word = re.compile(r"\\(.)|'([^']*)'|" r'"((?:[^"\\]|\\.)*)"', re.S).sub
+# Within double quotes, the escape character only escapes itself and `"`
+_unescape_double_quoted = re.compile(r'\\([\\"])').sub
+# Matches any character that requires an argument to be quoted; this is the same
+# pattern used by `shlex.quote`.
+_find_unsafe = re.compile(r"[^\w@%+=:,./-]", re.ASCII).search
 
 
 def quote_args(seq: Sequence[str]) -> str:
@@ -12,11 +33,17 @@ def quote_args(seq: Sequence[str]) -> str:
     Returns:
         Sequence of quoted command line arguments.
     """
-    return " ".join(shlex.quote(str(arg)) for arg in seq)
+    args = [str(arg) for arg in seq]
+    if all(args) and _find_unsafe("".join(args)) is None:
+        # Fast path: none of the arguments need to be quoted
+        return " ".join(args)
+    import shlex
+
+    return " ".join([shlex.quote(arg) for arg in args])
 
 
 def command_strings_to_lists(
-    cmds: Sequence[Union[str, Sequence[str]]]
+    cmds: Sequence[Union[str, Sequence[str]]],
 ) -> Sequence[Sequence[str]]:
     """
     Convert any command strings in `cmds` to lists.
@@ -25,13 +52,54 @@ def command_strings_to_lists(
         cmds: Commands - either strings or lists of arguments.
 
     Returns:
-        A sequence of command argument sequences.
+        A sequence of command argument sequences; `cmds` itself if it does not
+        contain any strings.
+    """
+    if not any(isinstance(cmd, str) for cmd in cmds):
+        return cmds
+    return [split_command(cmd) if isinstance(cmd, str) else cmd for cmd in cmds]
+
+
+def split_command(cmd: str) -> List[str]:
+    """
+    Split a command string into arguments using shell-like syntax. Equivalent to
+    `shlex.split(cmd)`, but uses `str.split` when the command contains no quotes or
+    escapes, and otherwise tokenizes the command using regular expressions. Falls
+    back to `shlex.split` (which raises a ValueError) if the command is malformed.
+
+    Args:
+        cmd: A command string.
+
+    Returns:
+        A list of command arguments.
     """
-    return [shlex.split(cmd) if isinstance(cmd, str) else cmd for cmd in cmds]
+    if _find_shlex_special(cmd) is None:
+        return cmd.split()
+    args = []
+    for match in _scan_command(cmd):
+        word, error = match.groups()
+        if error is not None:
+            break
+        if word is not None:
+            args.append(_unquote_word(_unquote, word))
+    else:
+        return args
+    import shlex
+
+    return shlex.split(cmd)
+
+
+def _unquote(match: "re.Match") -> str:
+    escaped, single_quoted, double_quoted = match.groups()
+    if escaped is not None:
+        return escaped
+    if single_quoted is not None:
+        return single_quoted
+    return _unescape_double_quoted(r"\1", double_quoted)
 
 
 def command_lists_to_strings(
-    cmds: Sequence[Union[str, Sequence[str]]]
+    cmds: Sequence[Union[str, Sequence[str]]],
 ) -> Sequence[str]:
     """
     Convert any command lists in `cmds` to strings.
@@ -40,6 +108,8 @@ def command_lists_to_strings(
         cmds: Commands - either strings or lists of arguments.
 
     Returns:
-        A sequence of command strings.
+        A sequence of command strings; `cmds` itself if it only contains strings.
     """
+    if all(isinstance(cmd, str) for cmd in cmds):
+        return cmds
     return [quote_args(cmd) if not isinstance(cmd, str) else cmd for cmd in cmds]
@@ -2,6 +2,7 @@ import contextlib
 import logging
 import os
 from pathlib import Path
+import shlex
 import shutil
 import subprocess
 import sys
@@ -54,11 +55,39 @@ def test_cmd():
     assert subby.cmd(["grep", "foo"], stdin="foo\nbar").output == "foo"
 
 
+@pytest.mark.skipif(
+    not getattr(subprocess, "_USE_POSIX_SPAWN", False), reason="requires posix_spawn"
+)
+def test_fast_spawn(monkeypatch):
+    calls = []
+    posix_spawn = os.posix_spawn
+
+    def _posix_spawn(*args, **kwargs):
+        calls.append(args[0])
+        return posix_spawn(*args, **kwargs)
+
+    monkeypatch.setattr(os, "posix_spawn", _posix_spawn)
+    assert subby.run([["echo", "hi"], ["cat"]]).output == "hi"
+    assert len(calls) == 2
+
+
+def test_echo(caplog):
+    with caplog.at_level(logging.INFO):
+        subby.run([["echo", "a b"], ["cat"]], stdout=subby.StdType.BUFFER)
+        subby.run("echo hi", echo=False)
+    assert caplog.messages == ["echo 'a b' | cat"]
+
+
 @pytest.mark.parametrize("mode,expected", [(bytes, b"foo"), (str, "foo")])
 def test_run_noblock(mode, expected):
     with isolated_dir():
+        # The first command sleeps so that the pipeline is reliably still running
+        # when we check `done`
         p = subby.run(
-            ["echo -n 'foo'", "gzip"], stdout=Path("foo.txt.gz"), block=False, mode=mode
+            ["sh -c 'sleep 0.5; echo -n foo'", "gzip"],
+            stdout=Path("foo.txt.gz"),
+            block=False,
+            mode=mode,
         )
         assert not p.done
         assert p.stdin_type is subby.StdType.OTHER
@@ -78,6 +107,14 @@ def test_timeout():
     with pytest.raises(subprocess.TimeoutExpired):
         p.block(timeout=1)
 
+    # Without any pipes to the final process, block() waits on the processes
+    # directly rather than via communicate()
+    p = subby.Processes([["sleep", "10"]], stdout=None, stderr=None)
+    p.run()
+    with pytest.raises(subprocess.TimeoutExpired):
+        p.block(timeout=1)
+    assert p.kill()
+
 
 @pytest.mark.parametrize("mode,expected", [(bytes, b"foo"), (str, "foo")])
 def test_run_str_command(mode, expected):
@@ -161,6 +198,17 @@ def test_state_errors():
         subby.Processes([["echo", "hi"]], mode=bytes, text=True)
 
 
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="requires /proc")
+def test_run_failure_no_leak():
+    # If a process in the pipeline cannot be started, the processes that were
+    # started are killed and no fds are leaked
+    before = set(os.listdir("/proc/self/fd"))
+    p = subby.Processes([["sleep", "10"], ["this-command-does-not-exist"]])
+    with pytest.raises(FileNotFoundError):
+        p.run()
+    assert set(os.listdir("/proc/self/fd")) == before
+
+
 @pytest.mark.parametrize(
     "mode,expected_stdout,expected_stderr", [(bytes, b"hi\n", b""), (str, "hi\n", "")]
 )
@@ -223,6 +271,15 @@ def test_stdin_bytes(mode, expected):
     assert expected == p.output
 
 
+@pytest.mark.parametrize("mode,expected", [(bytes, b"100000"), (str, "100000")])
+def test_stdin_large(mode, expected):
+    # Input larger than PIPE_BUF is spooled rather than written to a pipe up front
+    p = subby.Processes([["wc", "-c"]], stdin="x" * 100000, mode=mode)
+    p.run()
+    p.block()
+    assert expected == p.output
+
+
 @pytest.mark.parametrize("mode,expected", [(bytes, b"hi"), (str, "hi")])
 def test_stdin_sys(mode, expected):
     # We have to use a tempfile to mock stdin - an io.BytesIO doesn't work
@@ -261,6 +318,17 @@ def test_stdin_stream():
         p.block()
 
 
+def test_closed_stream():
+    # A stream that the caller has closed is not read by block()
+    p = subby.Processes([["echo", "hi"]])
+    p.run()
+    p.stdout_stream.close()
+    # echo may get SIGPIPE, depending on whether it writes before the close
+    p.block(raise_on_error=False)
+    assert p.output is None
+    assert p.error == ""
+
+
 @pytest.mark.parametrize(
     "mode,expected,expected_0", [(bytes, b"hi", b""), (str, "hi", "")]
 )
@@ -272,6 +340,27 @@ def test_get_all_stderr(mode, expected, expected_0):
     assert p.get_all_stderr() == [expected_0, expected, expected]
 
 
+def test_pipe_large():
+    # The final process writing more than a pipe's capacity to both stdout and
+    # stderr must not deadlock
+    p = subby.run(
+        [["sh", "-c", "head -c 200000 /dev/zero; head -c 200000 /dev/zero >&2"]],
+        mode=bytes,
+    )
+    assert p.output == b"\0" * 200000
+    assert p.error == b"\0" * 200000
+
+
+def test_get_all_stderr_large():
+    # A non-final process writing more than a pipe's capacity to stderr must not
+    # block while its stderr is being captured
+    p = subby.run(
+        [["sh", "-c", "head -c 200000 /dev/zero >&2; echo hi"], ["cat"]], mode=bytes
+    )
+    assert p.output == b"hi"
+    assert p.get_all_stderr() == [b"\0" * 200000, b""]
+
+
 @pytest.mark.parametrize(
     "mode,expected_stdout,expected_stderr", [(bytes, b"hi\n", b""), (str, "hi\n", "")]
 )
@@ -356,6 +445,39 @@ def test_allowed_returncodes(mode, expected):
     )
 
 
+@pytest.mark.parametrize("mode,expected", [(bytes, b"1"), (str, "1")])
+def test_shell_pool(mode, expected):
+    with subby.ShellPool(mode=mode) as pool:
+        assert pool.run("echo foo | wc -l").stdout == expected
+        assert pool.run([["echo", "foo"], ["wc", "-l"]]).stdout == expected
+        # Commands do not read from the shell's stdin
+        p = pool.run("echo hi >&2; cat")
+        assert p.returncode == 0
+        assert p.stdout == mode()
+        assert p.stderr == "hi".encode() if mode is bytes else "hi"
+        # Shell state persists between commands
+        pool.run("FOO=bar")
+        assert pool.run("echo $FOO").stdout == mode("bar", "UTF-8")
+        with pytest.raises(subprocess.CalledProcessError) as err:
+            pool.run("echo foo | grep bar")
+        assert err.value.returncode == 1
+        # A syntax error does not break the shell
+        with pytest.raises(subprocess.CalledProcessError):
+            pool.run('echo "foo')
+        assert pool.run("echo foo").stdout == mode("foo", "UTF-8")
+    assert pool.closed
+
+
+def test_shell_pool_exit():
+    with subby.ShellPool(allowed_return_codes=(0, 1)) as pool:
+        assert pool.run("echo foo | grep bar").returncode == 1
+        with pytest.raises(RuntimeError):
+            pool.run("exit 0")
+        assert pool.closed
+        # The shell is restarted by the next command
+        assert pool.run("echo foo").stdout == "foo"
+
+
 def test_readme_examples():
     # We can pass input to the stdin of the command as bytes
     input_str = "foo\nbar"
@@ -372,3 +494,45 @@ def test_readme_examples():
 
     # The `output` property provides the output of the command
     assert p1.output == p2.output == p3.output == "1"
+
+
+def test_command_conversions():
+    lists = [["grep", "foo"], ["wc", "-l"]]
+    strings = ["grep foo", "wc -l"]
+    mixed = [["grep", "foo"], "wc -l"]
+    assert subby.utils.command_strings_to_lists(lists) is lists
+    assert subby.utils.command_strings_to_lists(mixed) == lists
+    assert subby.utils.command_lists_to_strings(strings) is strings
+    assert subby.utils.command_lists_to_strings(mixed) == strings
+
+
+@pytest.mark.parametrize(
+    "cmd",
+    [
+        "",
+        "echo hi",
+        " grep  -c\tfoo \r\n",
+        "echo #hi",
+        "echo\x0bhi",
+        "echo 'a b'",
+        'echo "a \\"b\\" \\c"',
+        "echo a\\ b",
+        "echo a\"b c\"'d e'f",
+        "echo '' \"\" 'a\\b'",
+    ],
+)
+def test_split_command(cmd):
+    assert subby.utils.split_command(cmd) == shlex.split(cmd)
+
+
+@pytest.mark.parametrize("cmd", ["echo 'a", 'echo "a', "echo a\\"])
+def test_split_command_invalid(cmd):
+    with pytest.raises(ValueError):
+        subby.utils.split_command(cmd)
+
+
+@pytest.mark.parametrize(
+    "args", [[], ["echo", "hi"], ["grep", "-c", "a b"], ["", "it's", "$HOME", 1]]
+)
+def test_quote_args(args):
+    assert subby.utils.quote_args(args) == " ".join(shlex.quote(str(a)) for a in args)